@@ -0,0 +1,138 @@
+"""
+Multi-format text extractors.
+
+Kept free of app state so they can run in EXTRACTOR_POOL worker processes
+(spawned, not forked) without importing the model or DB clients. Errors
+are raised as ExtractionError, which pickles cleanly across the pool.
+"""
+
+import os
+import zipfile
+import csv
+
+from PyPDF2 import PdfReader
+from docx import Document as DocxDocument
+from pptx import Presentation
+from openpyxl import load_workbook
+from rapidocr_onnxruntime import RapidOCR
+
+
+class ExtractionError(Exception):
+    pass
+
+
+# In-process ONNX Runtime OCR, loaded once per pool worker
+_OCR = None
+
+
+def init_extractor_worker():
+    """EXTRACTOR_POOL initializer: warm the OCR model before the first image."""
+    global _OCR
+    _OCR = RapidOCR(intra_op_num_threads=int(os.getenv("OCR_THREADS", 1)))
+
+
+
+# =========================================================
+# 📄 Multi-format Text Extractors
+# =========================================================
+
+def extract_text_from_pdf(path: str) -> str:
+    try:
+        reader = PdfReader(path)
+        parts = []
+        for page in reader.pages:
+            content = page.extract_text()
+            if content:
+                parts.append(content)
+        return "\n".join(parts)
+    except:
+        raise ExtractionError("PDF extraction failed")
+
+
+def extract_text_from_docx(path: str) -> str:
+    try:
+        doc = DocxDocument(path)
+        return "\n".join([p.text for p in doc.paragraphs])
+    except:
+        raise ExtractionError("DOCX extraction failed")
+
+
+def extract_text_from_txt(path: str) -> str:
+    try:
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            return f.read()
+    except:
+        raise ExtractionError("TXT extraction failed")
+
+
+def extract_text_from_csv(path: str) -> str:
+    try:
+        rows = []
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            for row in csv.reader(f):
+                rows.append(" | ".join(row))
+        return "\n".join(rows)
+    except:
+        raise ExtractionError("CSV extraction failed")
+
+
+def extract_text_from_xlsx(path: str) -> str:
+    try:
+        wb = load_workbook(path)
+        text = ""
+        for sheet in wb.worksheets:
+            for row in sheet.iter_rows(values_only=True):
+                text += " | ".join([str(x) for x in row if x]) + "\n"
+        return text
+    except:
+        raise ExtractionError("XLS/XLSX extraction failed")
+
+
+def extract_text_from_pptx(path: str) -> str:
+    try:
+        prs = Presentation(path)
+        text = ""
+        for slide in prs.slides:
+            for shape in slide.shapes:
+                if hasattr(shape, "text"):
+                    text += shape.text + "\n"
+        return text
+    except:
+        raise ExtractionError("PPTX extraction failed")
+
+
+def extract_text_from_image(path: str) -> str:
+    try:
+        if _OCR is None:
+            init_extractor_worker()
+        result, _ = _OCR(path)
+        return "\n".join(text for _, text, _ in (result or []))
+    except:
+        raise ExtractionError("Image OCR failed")
+
+
+def extract_text_from_zip(path: str) -> str:
+    try:
+        text = ""
+        with zipfile.ZipFile(path) as z:
+            for filename in z.namelist():
+                if filename.endswith((".txt", ".csv")):
+                    text += z.read(filename).decode("utf-8", errors="ignore") + "\n"
+        return text
+    except:
+        raise ExtractionError("ZIP extraction failed")
+
+
+def extract_text_from_any(path: str) -> str:
+    ext = path.lower().split(".")[-1]
+
+    if ext == "pdf": return extract_text_from_pdf(path)
+    if ext == "docx": return extract_text_from_docx(path)
+    if ext == "txt": return extract_text_from_txt(path)
+    if ext == "csv": return extract_text_from_csv(path)
+    if ext in ["xlsx", "xls"]: return extract_text_from_xlsx(path)
+    if ext == "pptx": return extract_text_from_pptx(path)
+    if ext in ["jpg", "jpeg", "png", "webp"]: return extract_text_from_image(path)
+    if ext == "zip": return extract_text_from_zip(path)
+
+    raise ExtractionError(f"Unsupported file format: {ext}")
@@ -1,12 +1,18 @@
 import os
+import re
 import uuid
+import hashlib
+import asyncio
 import logging
-import random
+import threading
+import secrets
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Literal
+from typing import AsyncIterator, List, Dict, Optional, Literal, Tuple
 
-import json
+import orjson
 import faiss
+import numpy as np
 from fastapi import (
     FastAPI,
     UploadFile,
@@ -17,20 +23,19 @@ from fastapi import (
     Header,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, EmailStr
 
 # File Extractors
-from PyPDF2 import PdfReader
-from docx import Document as DocxDocument
-from pptx import Presentation
-from openpyxl import load_workbook
-from PIL import Image
-import pytesseract
-import zipfile
-import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import aiofiles
+from extractors import extract_text_from_any, init_extractor_worker, ExtractionError
 
 # RAG / Embeddings
-from sentence_transformers import SentenceTransformer
+import torch
+import ctranslate2
+from hf_hub_ctranslate2 import CT2SentenceTransformer
 
 # Auth / Security
 from dotenv import load_dotenv
@@ -39,12 +44,18 @@ from jose import jwt, JWTError
 
 # DB
 from motor.motor_asyncio import AsyncIOMotorClient
+import bson
+from pymongo.errors import DuplicateKeyError, PyMongoError
 
 # Gemini API
+import httpx
 from google import genai
+from google.genai import types as genai_types
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
 
+from cachetools import TTLCache
+
 
 
 # =========================================================
@@ -65,7 +76,15 @@ if not GEMINI_API_KEY:
 if not MONGO_URI:
     raise RuntimeError("❌ Missing MONGO_URI in .env")
 
-genai_client = genai.Client(api_key=GEMINI_API_KEY)
+# One process-wide client; `.aio` uses this bounded httpx pool (an explicit
+# client also keeps google-genai off aiohttp when that is installed)
+genai_client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=genai_types.HttpOptions(
+        httpx_async_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=100)),
+    ),
+)
+GEMINI_MODEL = "gemini-2.5-flash"
 
 
 
@@ -77,6 +96,7 @@ app = FastAPI(
     title="Smart Campus Assistant",
     description="RAG-powered campus study assistant with multi-format extraction",
     version="3.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 app.add_middleware(
@@ -89,6 +109,16 @@ app.add_middleware(
 
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MB
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "50")) << 20
+
+# CPU-bound parsing (PDF/OCR/XLSX) runs here, off the event loop
+# Sized per uvicorn worker; with --workers $(nproc) keep this small
+EXTRACTOR_POOL = ProcessPoolExecutor(
+    max_workers=int(os.getenv("EXTRACTOR_WORKERS", 2)),
+    mp_context=multiprocessing.get_context("spawn"),
+    initializer=init_extractor_worker,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("smart-campus")
@@ -113,6 +143,7 @@ shares_collection = db["shares"]
 # =========================================================
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+GOOGLE_REQUEST = google_requests.Request()  # reused HTTP session for token verification
 MAX_PASSWORD_LENGTH = 72  # bcrypt limit
 
 
@@ -140,8 +171,17 @@ async def get_user_by_email(email: str) -> Optional[dict]:
     return await users_collection.find_one({"email": email})
 
 
+# user_id -> user doc; spares get_current_user a Mongo round-trip per request
+USER_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+
 async def get_user_by_id(user_id: str) -> Optional[dict]:
-    return await users_collection.find_one({"id": user_id})
+    user = USER_CACHE.get(user_id)
+    if user is None:
+        user = await users_collection.find_one({"id": user_id})
+        if user:
+            USER_CACHE[user_id] = user
+    return user
 
 
 
@@ -182,118 +222,120 @@ async def get_current_user(Authorization: str = Header(None)):
 # 🧠 Embeddings + FAISS Setup
 # =========================================================
 
-logger.info("Loading sentence-transformer model…")
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# int8 CTranslate2 build of MiniLM (int8_float16 on GPU)
+if ctranslate2.get_cuda_device_count() > 0:
+    EMBED_DEVICE, EMBED_COMPUTE_TYPE = "cuda", "int8_float16"
+else:
+    EMBED_DEVICE, EMBED_COMPUTE_TYPE = "cpu", "int8"
+
+# CT2SentenceTransformer sizes its intra-op pool from torch's thread count;
+# one per process avoids oversubscribing cores across uvicorn workers.
+torch.set_num_threads(int(os.getenv("EMBED_THREADS", 1)))
+
+logger.info(f"Loading CTranslate2 sentence-transformer model ({EMBED_DEVICE}, {EMBED_COMPUTE_TYPE})…")
+embedder = CT2SentenceTransformer(
+    EMBED_MODEL_NAME,
+    compute_type=EMBED_COMPUTE_TYPE,
+    device=EMBED_DEVICE,
+)
 EMBED_DIM = embedder.get_sentence_embedding_dimension()
 logger.info(f"Embedding model loaded (dim={EMBED_DIM})")
 
-FAISS_INDEXES: Dict[str, faiss.IndexFlatIP] = {}
+# Model calls come from the query worker and upload threads; the HF fast
+# tokenizer is not safe to share across threads, so serialise them.
+EMBEDDER_LOCK = threading.Lock()
+
 MAX_CONTEXT_CHARS = 12000
 
+# Indexes, embeddings and token ids are only valid for the model that made
+# them, so they live under a directory keyed by (model name, dim).
+EMBED_KEY = f"{EMBED_MODEL_NAME.replace('/', '__')}-{EMBED_DIM}"
+INDEX_DIR = os.path.join(UPLOAD_DIR, "index", EMBED_KEY)
+os.makedirs(INDEX_DIR, exist_ok=True)
 
+# One multi-tenant index for every document. Vector ids pack the document
+# and chunk position as (doc_int << CHUNK_ID_BITS) | chunk_idx so a
+# per-document search is an IDSelectorRange over that document's block.
+# It lives in memory only: per-doc .npy files are the on-disk copy, and
+# each worker adds a document from its file on first search.
+CHUNK_ID_BITS = 20
+CHUNK_ID_MASK = (1 << CHUNK_ID_BITS) - 1
 
-# =========================================================
-# 📄 Multi-format Text Extractors
-# =========================================================
+# One query per search can't use OpenMP fan-out; scale with uvicorn
+# --workers instead (see Readme) and keep each process single-threaded.
+faiss.omp_set_num_threads(int(os.getenv("FAISS_OMP_THREADS", 1)))
 
-def extract_text_from_pdf(path: str) -> str:
-    try:
-        reader = PdfReader(path)
-        text = ""
-        for page in reader.pages:
-            content = page.extract_text()
-            if content:
-                text += content + "\n"
-        return text
-    except:
-        raise HTTPException(400, "PDF extraction failed")
-
-
-def extract_text_from_docx(path: str) -> str:
-    try:
-        doc = DocxDocument(path)
-        return "\n".join([p.text for p in doc.paragraphs])
-    except:
-        raise HTTPException(400, "DOCX extraction failed")
 
+def write_index_atomic(index: faiss.Index, path: str):
+    """Write then rename, so another worker never reads a half-written file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
 
-def extract_text_from_txt(path: str) -> str:
-    try:
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()
-    except:
-        raise HTTPException(400, "TXT extraction failed")
 
+# doc_id -> small int handed out in first-use order. The index is never
+# written to disk, so per-process numbering is enough and can't collide
+# the way a truncated uuid hash could.
+DOC_INTS: Dict[str, int] = {}
+DOC_INTS_LOCK = threading.Lock()
 
-def extract_text_from_csv(path: str) -> str:
-    try:
-        rows = []
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            for row in csv.reader(f):
-                rows.append(" | ".join(row))
-        return "\n".join(rows)
-    except:
-        raise HTTPException(400, "CSV extraction failed")
 
+def doc_id_to_int(doc_id: str) -> int:
+    doc_int = DOC_INTS.get(doc_id)
+    if doc_int is None:
+        with DOC_INTS_LOCK:
+            doc_int = DOC_INTS.setdefault(doc_id, len(DOC_INTS))
+    return doc_int
 
-def extract_text_from_xlsx(path: str) -> str:
-    try:
-        wb = load_workbook(path)
-        text = ""
-        for sheet in wb.worksheets:
-            for row in sheet.iter_rows(values_only=True):
-                text += " | ".join([str(x) for x in row if x]) + "\n"
-        return text
-    except:
-        raise HTTPException(400, "XLS/XLSX extraction failed")
 
+def new_faiss_index():
+    """SQ8 (int8 per component) inner-product index wrapped in an id map."""
+    sq = faiss.IndexScalarQuantizer(
+        EMBED_DIM, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+    )
+    # Embeddings are L2-normalised, so every component lies in [-1, 1];
+    # training on the bounds fixes one shared range for all documents.
+    sq.train(np.vstack([-np.ones(EMBED_DIM), np.ones(EMBED_DIM)]).astype(np.float32))
+    return faiss.IndexIDMap2(sq)
 
-def extract_text_from_pptx(path: str) -> str:
-    try:
-        prs = Presentation(path)
-        text = ""
-        for slide in prs.slides:
-            for shape in slide.shapes:
-                if hasattr(shape, "text"):
-                    text += shape.text + "\n"
-        return text
-    except:
-        raise HTTPException(400, "PPTX extraction failed")
-
-
-def extract_text_from_image(path: str) -> str:
-    try:
-        img = Image.open(path)
-        return pytesseract.image_to_string(img)
-    except:
-        raise HTTPException(400, "Image OCR failed")
 
+FAISS_INDEX = new_faiss_index()
+INDEXED_DOCS = set()
 
-def extract_text_from_zip(path: str) -> str:
-    try:
-        text = ""
-        with zipfile.ZipFile(path) as z:
-            for filename in z.namelist():
-                if filename.endswith((".txt", ".csv")):
-                    text += z.read(filename).decode("utf-8", errors="ignore") + "\n"
-        return text
-    except:
-        raise HTTPException(400, "ZIP extraction failed")
+# Uploads add to FAISS_INDEX from worker threads while /ask searches it
+FAISS_LOCK = threading.Lock()
 
+# Documents with at least HNSW_MIN_CHUNKS chunks get their own index
+# instead of a filtered flat scan; below that the graph overhead dominates.
+# On CPU that is an SQ8 HNSW graph, on GPU a GpuIndexFlatIP (no GPU HNSW).
+HNSW_MIN_CHUNKS = 512
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+LARGE_DOC_INDEXES: Dict[str, faiss.Index] = {}
 
-def extract_text_from_any(path: str) -> str:
-    ext = path.lower().split(".")[-1]
+# The shared index stays on CPU: GPU indexes don't support IDSelector filters
+FAISS_GPU_RES = faiss.StandardGpuResources() if faiss.get_num_gpus() > 0 else None
+# StandardGpuResources must not be used from several threads at once;
+# every GPU build and search holds this lock.
+GPU_LOCK = threading.Lock()
 
-    if ext == "pdf": return extract_text_from_pdf(path)
-    if ext == "docx": return extract_text_from_docx(path)
-    if ext == "txt": return extract_text_from_txt(path)
-    if ext == "csv": return extract_text_from_csv(path)
-    if ext in ["xlsx", "xls"]: return extract_text_from_xlsx(path)
-    if ext == "pptx": return extract_text_from_pptx(path)
-    if ext in ["jpg", "jpeg", "png", "webp"]: return extract_text_from_image(path)
-    if ext == "zip": return extract_text_from_zip(path)
+# Query micro-batching ("smart batching"): /ask queries arriving within
+# QUERY_MAX_WAIT_MS are coalesced, length-sorted and encoded in one call.
+QUERY_MAX_BATCH = 32
+QUERY_MAX_WAIT_MS = 10
+ENCODE_BATCH_SIZE = 32
+CHUNK_ENCODE_BATCH_SIZE = 64
 
-    raise HTTPException(400, f"Unsupported file format: {ext}")
+QUERY_QUEUE: "asyncio.Queue[Tuple[str, asyncio.Future]]" = asyncio.Queue()
+_query_worker_task: Optional[asyncio.Task] = None
+
+# LRU of query text -> float32 embedding bytes
+QUERY_CACHE_SIZE = 4096
+QUERY_EMBED_CACHE: "OrderedDict[str, bytes]" = OrderedDict()
+QUERY_INFLIGHT: Dict[str, asyncio.Future] = {}
 
 
 
@@ -302,48 +344,339 @@ def extract_text_from_any(path: str) -> str:
 # =========================================================
 
 def chunk_text(text: str, max_chars: int = 900) -> List[str]:
-    text = text.replace("\n", " ")
     words = text.split()
+    if not words:
+        return []
+
+    # Join once with single spaces; each chunk is then one slice of it.
+    # ends[i] is the offset just past word i plus its trailing space.
+    joined = " ".join(words)
+    ends = np.cumsum(
+        np.fromiter((len(w) + 1 for w in words), dtype=np.int64, count=len(words))
+    )
 
-    chunks, current = [], ""
-
-    for w in words:
-        if len(current) + len(w) + 1 <= max_chars:
-            current += w + " "
-        else:
-            if current.strip():
-                chunks.append(current.strip())
-            current = w + " "
+    chunks, start = [], 0
 
-    if current.strip():
-        chunks.append(current.strip())
+    while start < len(words):
+        base = int(ends[start - 1]) if start else 0
+        end = int(np.searchsorted(ends, base + max_chars, side="right"))
+        end = max(end, start + 1)  # an over-long word still forms its own chunk
+        chunks.append(joined[base:int(ends[end - 1]) - 1])
+        start = end
 
     return chunks
 
 
-def build_faiss_index_for_doc(doc_id: str, chunks: List[str]):
-    embeddings = embedder.encode(chunks, convert_to_numpy=True, normalize_embeddings=True)
-    index = faiss.IndexFlatIP(EMBED_DIM)
+def embeddings_path(doc_id: str) -> str:
+    return os.path.join(INDEX_DIR, f"{doc_id}.npy")
+
+
+def save_embeddings(doc_id: str, embeddings: np.ndarray):
+    # float16 on disk: half the bytes, and the SQ8 index quantizes far coarser anyway
+    np.save(embeddings_path(doc_id), embeddings.astype(np.float16))
+
+
+def tokens_path(doc_id: str) -> str:
+    return os.path.join(INDEX_DIR, f"{doc_id}.tokens.npz")
+
+
+def tokenize_chunks(chunks: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Tokenize once; returns (flat int32 token ids, per-chunk lengths)."""
+    with EMBEDDER_LOCK:
+        features = embedder.tokenize(chunks)
+    lengths = features["attention_mask"].sum(1).numpy().astype(np.int32)
+    input_ids = features["input_ids"].numpy().astype(np.int32)
+    flat = np.concatenate([input_ids[i, :n] for i, n in enumerate(lengths)])
+    return flat, lengths
+
+
+def encode_token_ids(flat: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Run the encoder on pre-tokenized chunks, skipping the HF tokenizer.
+    Chunks are encoded longest-first so each batch pads to similar lengths,
+    then rows are scattered back to their original order.
+    """
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    order = np.argsort(-lengths, kind="stable")
+    embeddings = np.empty((len(lengths), EMBED_DIM), dtype=np.float32)
+
+    for start in range(0, len(order), CHUNK_ENCODE_BATCH_SIZE):
+        rows = order[start:start + CHUNK_ENCODE_BATCH_SIZE]
+        width = int(lengths[rows].max())
+
+        input_ids = np.zeros((len(rows), width), dtype=np.int64)
+        attention_mask = np.zeros_like(input_ids)
+        for r, i in enumerate(rows):
+            input_ids[r, :lengths[i]] = flat[offsets[i]:offsets[i + 1]]
+            attention_mask[r, :lengths[i]] = 1
+
+        features = {
+            "input_ids": torch.from_numpy(input_ids),
+            "attention_mask": torch.from_numpy(attention_mask),
+            "token_type_ids": torch.zeros_like(torch.from_numpy(input_ids)),
+        }
+        features = {k: v.to(embedder.device) for k, v in features.items()}
+
+        with EMBEDDER_LOCK, torch.inference_mode():
+            embeddings[rows] = embedder(features)["sentence_embedding"].cpu().numpy()
+
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def hnsw_index_path(doc_id: str) -> str:
+    return os.path.join(INDEX_DIR, f"{doc_id}.hnsw")
+
+
+def add_doc_to_large_index(doc_id: str, embeddings: np.ndarray):
+    if FAISS_GPU_RES is not None:
+        with GPU_LOCK:
+            index = faiss.index_cpu_to_gpu(FAISS_GPU_RES, 0, faiss.IndexFlatIP(EMBED_DIM))
+            index.add(embeddings)
+        LARGE_DOC_INDEXES[doc_id] = index
+        return
+
+    # SQ8-coded graph; a large doc has enough vectors to train its own ranges
+    index = faiss.IndexHNSWSQ(
+        EMBED_DIM, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT
+    )
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.train(embeddings)
     index.add(embeddings)
-    FAISS_INDEXES[doc_id] = index
+    LARGE_DOC_INDEXES[doc_id] = index
+    write_index_atomic(index, hnsw_index_path(doc_id))
+
+
+def add_doc_to_index(doc_id: str, embeddings: np.ndarray):
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if len(embeddings) >= HNSW_MIN_CHUNKS:
+        add_doc_to_large_index(doc_id, embeddings)
+        return
+
+    doc_int = doc_id_to_int(doc_id)
+    base = doc_int << CHUNK_ID_BITS
+    ids = base | np.arange(len(embeddings), dtype=np.int64)
+
+    with FAISS_LOCK:
+        # remove_ids scans the whole corpus; only a re-add needs it
+        if doc_int in INDEXED_DOCS:
+            FAISS_INDEX.remove_ids(faiss.IDSelectorRange(base, base + (1 << CHUNK_ID_BITS)))
+        FAISS_INDEX.add_with_ids(embeddings, ids)
+        INDEXED_DOCS.add(doc_int)
+
+
+def build_faiss_index_for_doc(doc_id: str, chunks: List[str]):
+    flat, lengths = tokenize_chunks(chunks)
+    np.savez_compressed(tokens_path(doc_id), ids=flat, lengths=lengths)
+
+    embeddings = encode_token_ids(flat, lengths)
+    save_embeddings(doc_id, embeddings)
+    add_doc_to_index(doc_id, embeddings)
     logger.info(f"FAISS index built for doc {doc_id} ({len(chunks)} chunks)")
+    return embeddings
 
 
-def retrieve_top_chunks(doc_id: str, query: str, chunks: List[str], top_k=5):
-    if doc_id not in FAISS_INDEXES:
-        build_faiss_index_for_doc(doc_id, chunks)
+def load_faiss_index_for_doc(
+    doc_id: str, chunks: List[str], stored: Optional[np.ndarray] = None
+):
+    """
+    Re-add a doc to the index from what upload saved:
+    HNSW graph or embeddings on disk, else embeddings kept in Mongo
+    (`stored`), else token ids (encode only), else full rebuild.
+    """
+    path = hnsw_index_path(doc_id)
+
+    if FAISS_GPU_RES is None and os.path.exists(path):
+        LARGE_DOC_INDEXES[doc_id] = faiss.read_index(path)
+        logger.info(f"HNSW index loaded for doc {doc_id} from {path}")
+        return
+
+    path = embeddings_path(doc_id)
+
+    if os.path.exists(path):
+        embeddings = np.load(path).astype(np.float32)
+        if len(embeddings) == len(chunks):
+            add_doc_to_index(doc_id, embeddings)
+            logger.info(f"FAISS index loaded for doc {doc_id} from {path}")
+            return
+
+    if stored is not None and len(stored) == len(chunks):
+        save_embeddings(doc_id, stored)
+        add_doc_to_index(doc_id, stored)
+        logger.info(f"FAISS index loaded for doc {doc_id} from Mongo embeddings")
+        return
+
+    path = tokens_path(doc_id)
+
+    if os.path.exists(path):
+        tokens = np.load(path)
+        if len(tokens["lengths"]) == len(chunks):
+            embeddings = encode_token_ids(tokens["ids"], tokens["lengths"])
+            save_embeddings(doc_id, embeddings)
+            add_doc_to_index(doc_id, embeddings)
+            logger.info(f"FAISS index re-encoded for doc {doc_id} from {path}")
+            return
 
-    q_emb = embedder.encode([query], convert_to_numpy=True, normalize_embeddings=True)
-    index = FAISS_INDEXES[doc_id]
+    build_faiss_index_for_doc(doc_id, chunks)
 
-    _, idxs = index.search(q_emb, top_k)
-    idxs = idxs[0]
 
-    return [chunks[i] for i in idxs if 0 <= i < len(chunks)]
+# Embeddings are also kept on the Mongo record (float16 bytes) so a fresh
+# worker or an emptied disk can rebuild without re-encoding. Skipped when
+# the record plus embeddings would come near the 16 MB BSON limit.
+MAX_STORED_RECORD_BYTES = 12 << 20
+
+
+async def store_embeddings(doc_id: str, embeddings: np.ndarray, record_bytes: int):
+    """Best effort: the embeddings are only a cache, so failures are logged."""
+    data = embeddings.astype(np.float16).tobytes()
+    if record_bytes + len(data) > MAX_STORED_RECORD_BYTES:
+        return
+    try:
+        await docs_collection.update_one(
+            {"id": doc_id},
+            {"$set": {"embeddings": data, "embed_key": EMBED_KEY}},
+        )
+    except PyMongoError as e:
+        logger.warning(f"Could not store embeddings for doc {doc_id}: {e}")
+
+
+async def load_stored_embeddings(doc_id: str) -> Optional[np.ndarray]:
+    doc = await docs_collection.find_one(
+        {"id": doc_id},
+        {"_id": 0, "embeddings": 1, "embed_key": 1},
+    )
+    if not doc or not doc.get("embeddings") or doc.get("embed_key") != EMBED_KEY:
+        return None
+    return (
+        np.frombuffer(doc["embeddings"], dtype=np.float16)
+        .reshape(-1, EMBED_DIM)
+        .astype(np.float32)
+    )
+
+
+def encode_queries(queries: List[str]):
+    with EMBEDDER_LOCK:
+        embeddings = embedder.encode(
+            queries,
+            batch_size=ENCODE_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+    # C-contiguous float32 rows go to FAISS and the cache without conversion
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+async def query_embedding_worker():
+    """
+    Drain QUERY_QUEUE in micro-batches:
+    - wait QUERY_MAX_WAIT_MS for more queries to arrive
+    - sort the batch by length to minimise padding
+    - encode once off the event loop and scatter rows back to the futures
+    """
+    loop = asyncio.get_running_loop()
+
+    while True:
+        batch = [await QUERY_QUEUE.get()]
+        await asyncio.sleep(QUERY_MAX_WAIT_MS / 1000)
+        while len(batch) < QUERY_MAX_BATCH and not QUERY_QUEUE.empty():
+            batch.append(QUERY_QUEUE.get_nowait())
+
+        order = sorted(range(len(batch)), key=lambda i: len(batch[i][0].split()))
+
+        try:
+            embeddings = await loop.run_in_executor(
+                None, encode_queries, [batch[i][0] for i in order]
+            )
+        except Exception as e:
+            logger.exception("Query embedding failed: %s", e)
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        for row, i in enumerate(order):
+            fut = batch[i][1]
+            if not fut.done():
+                fut.set_result(embeddings[row:row + 1])
+
+
+async def embed_query(query: str):
+    cached = QUERY_EMBED_CACHE.get(query)
+    if cached is not None:
+        QUERY_EMBED_CACHE.move_to_end(query)
+        return np.frombuffer(cached, dtype=np.float32).reshape(1, EMBED_DIM)
+
+    # Identical queries already waiting on the encoder share its result
+    fut = QUERY_INFLIGHT.get(query)
+    if fut is not None:
+        return await asyncio.shield(fut)
+
+    fut = asyncio.get_running_loop().create_future()
+    QUERY_INFLIGHT[query] = fut
+    try:
+        await QUERY_QUEUE.put((query, fut))
+        q_emb = await asyncio.shield(fut)
+    finally:
+        QUERY_INFLIGHT.pop(query, None)
+
+    QUERY_EMBED_CACHE[query] = q_emb.tobytes()
+    if len(QUERY_EMBED_CACHE) > QUERY_CACHE_SIZE:
+        QUERY_EMBED_CACHE.popitem(last=False)
+
+    return q_emb
+
+
+def search_doc_index(doc_id: str, q_emb: np.ndarray, top_k: int) -> np.ndarray:
+    """Return the chunk positions of the top_k hits within one document."""
+    if doc_id in LARGE_DOC_INDEXES:
+        if FAISS_GPU_RES is not None:
+            with GPU_LOCK:
+                _, ids = LARGE_DOC_INDEXES[doc_id].search(q_emb, top_k)
+        else:
+            params = faiss.SearchParametersHNSW(efSearch=HNSW_EF_SEARCH)
+            _, ids = LARGE_DOC_INDEXES[doc_id].search(q_emb, top_k, params=params)
+        ids = ids[0]
+        return ids[ids >= 0]
+
+    base = doc_id_to_int(doc_id) << CHUNK_ID_BITS
+    params = faiss.SearchParameters(
+        sel=faiss.IDSelectorRange(base, base + (1 << CHUNK_ID_BITS))
+    )
+    with FAISS_LOCK:
+        _, ids = FAISS_INDEX.search(q_emb, top_k, params=params)
+    ids = ids[0]
+    return ids[ids >= 0] & CHUNK_ID_MASK
+
+
+async def retrieve_top_chunks(doc_id: str, query: str, chunks: List[str], top_k=5):
+    doc_int = doc_id_to_int(doc_id)
+    if doc_id not in LARGE_DOC_INDEXES and doc_int not in INDEXED_DOCS:
+        stored = None
+        if not os.path.exists(embeddings_path(doc_id)):
+            stored = await load_stored_embeddings(doc_id)
+        await asyncio.to_thread(load_faiss_index_for_doc, doc_id, chunks, stored)
+
+    q_emb = await embed_query(query)
+
+    # In a thread: FAISS_LOCK may be held by an upload writing the index
+    idxs = await asyncio.to_thread(search_doc_index, doc_id, q_emb, top_k)
+
+    return [chunks[i] for i in idxs[idxs < len(chunks)].tolist()]
 
 
 def trim_context(context: str, max_chars=MAX_CONTEXT_CHARS):
-    return context if len(context) <= max_chars else context[-max_chars:]
+    """
+    Keep the last max_chars of context, starting at a chunk boundary ("\n\n")
+    so the prompt never opens mid-word; plain char slice if there is none.
+    """
+    if len(context) <= max_chars:
+        return context
+
+    cut = len(context) - max_chars
+    nl = context.find("\n\n", cut)
+    if nl != -1 and nl + 2 < len(context):
+        return context[nl + 2:]
+    return context[cut:]
 
 
 
@@ -351,12 +684,12 @@ def trim_context(context: str, max_chars=MAX_CONTEXT_CHARS):
 # GEMINI API CALL
 # =========================================================
 
-def call_gemini(system_prompt: str, user_prompt: str) -> str:
+async def call_gemini(system_prompt: str, user_prompt: str) -> str:
     full = f"{system_prompt}\n\n{user_prompt}"
 
     try:
-        resp = genai_client.models.generate_content(
-            model="gemini-2.5-flash",
+        resp = await genai_client.aio.models.generate_content(
+            model=GEMINI_MODEL,
             contents=full,
         )
         return (resp.text or "").strip()
@@ -366,6 +699,34 @@ def call_gemini(system_prompt: str, user_prompt: str) -> str:
         raise HTTPException(500, "Gemini API error")
 
 
+async def stream_gemini(system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+    """
+    Open a streaming Gemini call and return an iterator of text deltas.
+    Errors opening the stream still surface as a 500; errors mid-stream
+    can only end the response early.
+    """
+    full = f"{system_prompt}\n\n{user_prompt}"
+
+    try:
+        stream = await genai_client.aio.models.generate_content_stream(
+            model=GEMINI_MODEL,
+            contents=full,
+        )
+    except Exception as e:
+        logger.exception("Gemini API error: %s", e)
+        raise HTTPException(500, "Gemini API error")
+
+    async def deltas():
+        try:
+            async for chunk in stream:
+                if chunk.text:
+                    yield chunk.text
+        except Exception as e:
+            logger.exception("Gemini stream error: %s", e)
+
+    return deltas()
+
+
 
 # =========================================================
 # PYDANTIC MODELS
@@ -441,7 +802,7 @@ async def google_login(payload: GoogleLoginRequest):
     try:
         idinfo = id_token.verify_oauth2_token(
             payload.credential,
-            google_requests.Request(),
+            GOOGLE_REQUEST,
             None,
         )
 
@@ -462,7 +823,11 @@ async def google_login(payload: GoogleLoginRequest):
                 "provider": "google",
                 "created_at": datetime.utcnow(),
             }
-            await users_collection.insert_one(user)
+            try:
+                await users_collection.insert_one(user)
+            except DuplicateKeyError:
+                # A concurrent first login for this email created the user
+                user = await users_collection.find_one({"email": email})
 
         token = create_access_token(user["id"])
 
@@ -488,17 +853,23 @@ async def register(user_in: UserCreate):
         raise HTTPException(400, "Email already registered")
 
     user_id = str(uuid.uuid4())
+    password_hash = await asyncio.to_thread(hash_password, user_in.password)
 
     user_doc = {
         "id": user_id,
         "email": user_in.email,
         "name": user_in.name or user_in.email.split("@")[0],
-        "password_hash": hash_password(user_in.password),
+        "password_hash": password_hash,
         "provider": "local",
         "created_at": datetime.utcnow(),
     }
 
-    await users_collection.insert_one(user_doc)
+    # The unique email index catches a concurrent registration that passed
+    # the check above at the same time
+    try:
+        await users_collection.insert_one(user_doc)
+    except DuplicateKeyError:
+        raise HTTPException(400, "Email already registered")
 
     token = create_access_token(user_id)
 
@@ -519,7 +890,7 @@ async def login(user_in: UserLogin):
         raise HTTPException(401, "Invalid credentials")
 
     hashed = user.get("password_hash")
-    if not hashed or not verify_password(user_in.password, hashed):
+    if not hashed or not await asyncio.to_thread(verify_password, user_in.password, hashed):
         raise HTTPException(401, "Invalid credentials")
 
     token = create_access_token(user["id"])
@@ -546,6 +917,39 @@ async def me(current_user: dict = Depends(get_current_user)):
 
 
 
+# =========================================================
+# 🚦 STARTUP
+# =========================================================
+
+@app.on_event("startup")
+async def start_query_embedding_worker():
+    global _query_worker_task
+    _query_worker_task = asyncio.create_task(query_embedding_worker())
+
+
+@app.on_event("startup")
+async def warm_up_embedder():
+    """Run one encode so lazy model init doesn't land on the first request."""
+    await asyncio.to_thread(encode_queries, ["warmup"])
+    logger.info("Embedding model warmed up")
+
+
+@app.on_event("startup")
+async def create_indexes():
+    """Every lookup in this API is a point query; back each one with an index."""
+    await users_collection.create_index("email", unique=True)
+    await users_collection.create_index("id", unique=True)
+    await docs_collection.create_index("id", unique=True)
+    await docs_collection.create_index([("user_id", 1), ("created_at", -1)])
+    await shares_collection.create_index("code", unique=True)
+
+
+@app.on_event("shutdown")
+async def shutdown_extractor_pool():
+    EXTRACTOR_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+
 # =========================================================
 # 🩺 HEALTH CHECK
 # =========================================================
@@ -584,16 +988,33 @@ async def upload_document(
     doc_id = str(uuid.uuid4())
     save_path = os.path.join(UPLOAD_DIR, f"{doc_id}.{ext}")
 
-    with open(save_path, "wb") as f:
-        f.write(await file.read())
+    # Stream to disk, hashing and enforcing the size limit as we go
+    sha256 = hashlib.sha256()
+    size = 0
 
-    # Extract text (multi-format)
-    raw_text = extract_text_from_any(save_path)
+    async with aiofiles.open(save_path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                break
+            sha256.update(chunk)
+            await out.write(chunk)
+
+    if size > MAX_UPLOAD_BYTES:
+        os.remove(save_path)
+        raise HTTPException(413, f"File exceeds {MAX_UPLOAD_BYTES >> 20} MB limit")
+
+    # Extract text (multi-format) in the extractor process pool
+    loop = asyncio.get_running_loop()
+    try:
+        raw_text = await loop.run_in_executor(EXTRACTOR_POOL, extract_text_from_any, save_path)
+    except ExtractionError as e:
+        raise HTTPException(400, str(e))
 
     if not raw_text.strip():
         raise HTTPException(400, "No readable text extracted from file")
 
-    chunks = chunk_text(raw_text)
+    chunks = await asyncio.to_thread(chunk_text, raw_text)
     created_at = datetime.utcnow()
 
     doc_entry = {
@@ -601,16 +1022,22 @@ async def upload_document(
         "user_id": current_user["id"],
         "title": title or filename,
         "subject": subject,
-        "raw_text": raw_text,
         "chunks": chunks,
+        # Fixed prompt contexts for /summarize and /quiz, built once here
+        "summary_ctx": trim_context("\n\n".join(chunks[:SUMMARY_CHUNKS])),
+        "quiz_ctx": trim_context("\n\n".join(chunks[:QUIZ_CHUNKS])),
         "created_at": created_at,
         "file_ext": ext,
+        "file_size": size,
+        "sha256": sha256.hexdigest(),
     }
 
-    await docs_collection.insert_one(doc_entry)
-
-    # Build FAISS index
-    build_faiss_index_for_doc(doc_id, chunks)
+    # Insert into Mongo while the FAISS index builds off the event loop
+    _, embeddings = await asyncio.gather(
+        docs_collection.insert_one(doc_entry),
+        asyncio.to_thread(build_faiss_index_for_doc, doc_id, chunks),
+    )
+    await store_embeddings(doc_id, embeddings, len(bson.encode(doc_entry)))
 
     return {
         "status": "ok",
@@ -629,9 +1056,19 @@ async def upload_document(
 
 @app.get("/documents")
 async def list_documents(current_user: dict = Depends(get_current_user)):
-    cursor = docs_collection.find(
-        {"user_id": current_user["id"]}
-    ).sort("created_at", -1)
+    # Count chunks server-side so the chunk arrays never leave Mongo
+    cursor = docs_collection.aggregate([
+        {"$match": {"user_id": current_user["id"]}},
+        {"$sort": {"created_at": -1}},
+        {"$project": {
+            "_id": 0,
+            "id": 1,
+            "title": 1,
+            "subject": 1,
+            "created_at": 1,
+            "num_chunks": {"$size": {"$ifNull": ["$chunks", []]}},
+        }},
+    ])
 
     docs = []
     async for d in cursor:
@@ -639,7 +1076,7 @@ async def list_documents(current_user: dict = Depends(get_current_user)):
             "id": d["id"],
             "title": d["title"],
             "subject": d["subject"],
-            "num_chunks": len(d.get("chunks", [])),
+            "num_chunks": d["num_chunks"],
             "created_at": d["created_at"].isoformat(),
         })
 
@@ -651,42 +1088,116 @@ async def list_documents(current_user: dict = Depends(get_current_user)):
 # GET DOCUMENT FOR USER
 # =========================================================
 
-async def get_doc_for_user(doc_id: str, user_id: str):
-    doc = await docs_collection.find_one({"id": doc_id, "user_id": user_id})
+SUMMARY_CHUNKS = 15
+QUIZ_CHUNKS = 12
+
+
+# (doc_id, user_id) -> full chunk list; chunks never change after upload,
+# so repeated /ask calls on one document skip the Mongo read.
+# Bounded by total characters per worker, not by document count.
+DOC_CHUNKS_CACHE_CHARS = int(os.getenv("DOC_CACHE_MB", 64)) << 20
+DOC_CHUNKS_CACHE: TTLCache = TTLCache(
+    maxsize=DOC_CHUNKS_CACHE_CHARS,
+    ttl=300,
+    getsizeof=lambda chunks: sum(map(len, chunks)) or 1,
+)
+
+
+async def get_doc_for_user(doc_id: str, user_id: str, max_chunks: Optional[int] = None):
+    """
+    Fetch only the chunks of a user's document.
+    With max_chunks, Mongo slices the array so only the first N chunks are sent.
+    """
+    key = (doc_id, user_id)
+    chunks = DOC_CHUNKS_CACHE.get(key)
+    if chunks is not None:
+        return {"chunks": chunks[:max_chunks] if max_chunks else chunks}
+
+    # A lone $slice makes Mongo treat the projection as an exclusion and send
+    # every other field (embeddings, contexts, legacy raw_text); including
+    # `id` keeps it an inclusion projection
+    chunks_projection = {"$slice": max_chunks} if max_chunks else 1
+    doc = await docs_collection.find_one(
+        {"id": doc_id, "user_id": user_id},
+        {"_id": 0, "id": 1, "chunks": chunks_projection},
+    )
     if not doc:
         raise HTTPException(404, "Document not found")
+    if not max_chunks:
+        chunks = doc.get("chunks", [])
+        # Skip documents over a quarter of the budget so one can't evict the rest
+        if DOC_CHUNKS_CACHE.getsizeof(chunks) <= DOC_CHUNKS_CACHE_CHARS // 4:
+            DOC_CHUNKS_CACHE[key] = chunks
     return doc
 
 
+async def get_context_for_user(doc_id: str, user_id: str, ctx_field: str, max_chunks: int) -> str:
+    """
+    Return the prompt context precomputed at upload (`summary_ctx` / `quiz_ctx`).
+    Documents uploaded before these fields existed join their chunks once and
+    store the result, so later calls read it back like a fresh upload.
+    """
+    doc = await docs_collection.find_one(
+        {"id": doc_id, "user_id": user_id},
+        {"_id": 0, ctx_field: 1},
+    )
+    if not doc:
+        raise HTTPException(404, "Document not found")
+    if doc.get(ctx_field):
+        return doc[ctx_field]
+
+    doc = await get_doc_for_user(doc_id, user_id, max_chunks=max_chunks)
+    chunks = doc.get("chunks", [])
+
+    if not chunks:
+        raise HTTPException(400, "Document contains no chunks")
+
+    context = trim_context("\n\n".join(chunks[:max_chunks]))
+    await docs_collection.update_one(
+        {"id": doc_id, "user_id": user_id},
+        {"$set": {ctx_field: context}},
+    )
+    return context
+
+
 
 # =========================================================
 # 🤖 ASK AI (RAG)
 # =========================================================
 
-@app.post("/ask")
-async def ask_question(
-    req: AskRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    doc = await get_doc_for_user(req.doc_id, current_user["id"])
+ASK_SYSTEM_PROMPT = (
+    "You are a Smart Campus AI tutor.\n"
+    "Use ONLY the given CONTEXT from notes.\n"
+    "If the answer is missing, reply exactly: 'Not enough information in the notes.'\n"
+    "Explain clearly, simply, and exam-focused."
+)
+
+
+async def build_ask_prompt(req: AskRequest, user_id: str) -> Tuple[str, List[str]]:
+    doc = await get_doc_for_user(req.doc_id, user_id)
     chunks = doc.get("chunks", [])
 
     if not chunks:
         raise HTTPException(400, "Document contains no chunks")
 
-    top_chunks = retrieve_top_chunks(req.doc_id, req.question, chunks, top_k=5)
+    # Repeated slides/pages produce identical chunks; send each text once
+    top_chunks = list(dict.fromkeys(
+        await retrieve_top_chunks(req.doc_id, req.question, chunks, top_k=5)
+    ))
     context = trim_context("\n\n".join(top_chunks))
 
-    system_prompt = (
-        "You are a Smart Campus AI tutor.\n"
-        "Use ONLY the given CONTEXT from notes.\n"
-        "If the answer is missing, reply exactly: 'Not enough information in the notes.'\n"
-        "Explain clearly, simply, and exam-focused."
-    )
-
     user_prompt = f"CONTEXT:\n{context}\n\nQUESTION:\n{req.question}"
+    return user_prompt, top_chunks
 
-    answer = call_gemini(system_prompt, user_prompt)
+
+@app.post("/ask")
+async def ask_question(
+    req: AskRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    user_prompt, top_chunks = await build_ask_prompt(req, current_user["id"])
+
+    answer = await call_gemini(ASK_SYSTEM_PROMPT, user_prompt)
 
     return {
         "status": "ok",
@@ -695,59 +1206,129 @@ async def ask_question(
     }
 
 
+@app.post("/ask/stream")
+async def ask_question_stream(
+    req: AskRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Same as /ask, but streams the answer as plain text while Gemini generates it."""
+    user_prompt, _ = await build_ask_prompt(req, current_user["id"])
+
+    deltas = await stream_gemini(ASK_SYSTEM_PROMPT, user_prompt)
+
+    return StreamingResponse(deltas, media_type="text/plain; charset=utf-8")
+
+
 
 # =========================================================
 # ✍️ SUMMARY GENERATION
 # =========================================================
 
-@app.post("/summarize")
-async def summarize_document(
-    req: SummarizeRequest,
-    current_user: dict = Depends(get_current_user),
-):
-    doc = await get_doc_for_user(req.doc_id, current_user["id"])
+SUMMARY_SYSTEM_PROMPT = (
+    "You are an AI that writes exam-oriented answers using ONLY the student's notes.\n"
+    "Never add outside information."
+)
+
+# 15-mark answers are written as parallel sections over overlapping chunk windows
+LONG_ANSWER_SECTIONS = 3
+
+
+def summary_prompt(context: str, task: str, length_rules: str) -> str:
+    return f"""
+CONTEXT:
+{context}
+
+TASK:
+{task}
+
+RULES:
+- {length_rules}
+- Use clear exam language
+- Use bullets/headings where helpful
+- Do NOT say 'summary' or 'AI'
+"""
+
+
+def overlapping_windows(chunks: List[str], n: int, overlap: int = 1) -> List[List[str]]:
+    size = -(-len(chunks) // n)
+    return [
+        chunks[max(0, i * size - overlap):(i + 1) * size]
+        for i in range(n)
+        if chunks[i * size:(i + 1) * size]
+    ]
+
+
+async def write_long_answer(doc_id: str, user_id: str, focus_text: str) -> str:
+    """Write a 15-mark answer as concurrent Gemini calls, one per section."""
+    doc = await get_doc_for_user(doc_id, user_id, max_chunks=SUMMARY_CHUNKS)
     chunks = doc.get("chunks", [])
 
     if not chunks:
         raise HTTPException(400, "Document contains no chunks")
 
-    selected_chunks = chunks[:15]
-    context = trim_context("\n\n".join(selected_chunks))
+    windows = overlapping_windows(chunks[:SUMMARY_CHUNKS], LONG_ANSWER_SECTIONS)
+
+    if len(windows) == 1:
+        user_prompt = summary_prompt(
+            trim_context("\n\n".join(windows[0])),
+            f"Provide a 15-mark answer on: {focus_text}",
+            "Write a 20+ line detailed answer with headings, explanations, "
+            "examples, and a conclusion.",
+        )
+        return await call_gemini(SUMMARY_SYSTEM_PROMPT, user_prompt)
+
+    prompts = []
+
+    for i, window in enumerate(windows):
+        rules = (
+            "Write 7+ lines with headings, explanations, and examples. "
+            "Cover only what this CONTEXT adds; other parts are written separately."
+        )
+        if i == 0:
+            rules += " Open with an introduction/definition."
+        if i == len(windows) - 1:
+            rules += " End with a conclusion."
+
+        task = f"Write part {i + 1} of {len(windows)} of a 15-mark answer on: {focus_text}"
+        prompts.append(summary_prompt(trim_context("\n\n".join(window)), task, rules))
+
+    parts = await asyncio.gather(
+        *(call_gemini(SUMMARY_SYSTEM_PROMPT, p) for p in prompts)
+    )
+    return "\n\n".join(parts)
 
+
+@app.post("/summarize")
+async def summarize_document(
+    req: SummarizeRequest,
+    current_user: dict = Depends(get_current_user),
+):
     # Mark-dependent formatting
     mark = req.mark_type or "2"
     focus_text = req.focus or "important exam topics"
 
+    if mark == "15":
+        summary_text = await write_long_answer(req.doc_id, current_user["id"], focus_text)
+        return {
+            "status": "ok",
+            "summary": summary_text,
+            "mark_type": mark,
+        }
+
+    context = await get_context_for_user(
+        req.doc_id, current_user["id"], "summary_ctx", SUMMARY_CHUNKS
+    )
+
     if mark == "2":
         length_rules = "Write a short 4–5 line answer, crisp and point-wise."
-    elif mark == "5":
-        length_rules = "Write an 8–10 line answer including definition and key points."
     else:
-        length_rules = (
-            "Write a 20+ line detailed answer with headings, explanations, "
-            "examples, and a conclusion."
-        )
+        length_rules = "Write an 8–10 line answer including definition and key points."
 
-    system_prompt = (
-        "You are an AI that writes exam-oriented answers using ONLY the student's notes.\n"
-        "Never add outside information."
+    user_prompt = summary_prompt(
+        context, f"Provide a {mark}-mark answer on: {focus_text}", length_rules
     )
 
-    user_prompt = f"""
-CONTEXT:
-{context}
-
-TASK:
-Provide a {mark}-mark answer on: {focus_text}
-
-RULES:
-- {length_rules}
-- Use clear exam language
-- Use bullets/headings where helpful
-- Do NOT say 'summary' or 'AI'
-"""
-
-    summary_text = call_gemini(system_prompt, user_prompt)
+    summary_text = await call_gemini(SUMMARY_SYSTEM_PROMPT, user_prompt)
 
     return {
         "status": "ok",
@@ -761,22 +1342,23 @@ RULES:
 # 📝 QUIZ GENERATION
 # =========================================================
 
+# Only an opening fence (```, ```json, …) and a closing fence are removed;
+# backticks inside the JSON body, e.g. in an explanation, are left alone
+CODE_FENCE_RE = re.compile(r"^```[A-Za-z]*\s*|\s*```$")
+
+
 @app.post("/quiz")
 async def generate_quiz(
     req: QuizRequest,
     current_user: dict = Depends(get_current_user),
 ):
-    doc = await get_doc_for_user(req.doc_id, current_user["id"])
-    chunks = doc.get("chunks", [])
-
-    if not chunks:
-        raise HTTPException(400, "Document contains no chunks")
+    context = await get_context_for_user(
+        req.doc_id, current_user["id"], "quiz_ctx", QUIZ_CHUNKS
+    )
 
     if not (1 <= req.num_questions <= 20):
         raise HTTPException(400, "num_questions must be between 1 and 20")
 
-    context = trim_context("\n\n".join(chunks[:12]))
-
     system_prompt = (
         "You are an AI that outputs ONLY VALID JSON.\n"
         "NO markdown. NO commentary."
@@ -798,15 +1380,15 @@ Generate exactly {req.num_questions} MCQs in JSON:
 ]
 """
 
-    raw = call_gemini(system_prompt, user_prompt).strip()
+    raw = (await call_gemini(system_prompt, user_prompt)).strip()
 
     # Remove accidental markdown code fences
     if raw.startswith("```"):
-        raw = raw.replace("```json", "").replace("```", "").strip()
+        raw = CODE_FENCE_RE.sub("", raw)
 
     try:
-        quiz_json = json.loads(raw)
-    except:
+        quiz_json = orjson.loads(raw)
+    except orjson.JSONDecodeError:
         logger.error("Invalid JSON returned:\n" + raw)
         raise HTTPException(500, "AI returned invalid JSON")
 
@@ -821,16 +1403,20 @@ Generate exactly {req.num_questions} MCQs in JSON:
 # 🔗 SHARE CODE GENERATION (6-DIGIT)
 # =========================================================
 
-async def generate_unique_code() -> str:
+async def insert_share_with_unique_code(share_doc: dict) -> str:
     """
-    Generate a unique 6-digit numeric code.
-    Retries up to 20 times before failing.
+    Insert a share under a fresh 6-digit numeric code drawn from `secrets`,
+    so codes can't be predicted from earlier ones.
+    The unique index on `code` rejects collisions, so each attempt is a
+    single insert. Retries up to 20 times before failing.
     """
     for _ in range(20):
-        code = f"{random.randint(0, 999999):06d}"
-        exists = await shares_collection.find_one({"code": code})
-        if not exists:
+        code = f"{secrets.randbelow(1_000_000):06d}"
+        try:
+            await shares_collection.insert_one({**share_doc, "code": code})
             return code
+        except DuplicateKeyError:
+            continue
     raise HTTPException(500, "Failed to generate unique share code")
 
 
@@ -854,18 +1440,16 @@ async def share_create(
     if req.type not in {"ask", "summary", "quiz"}:
         raise HTTPException(400, "Invalid share type")
 
-    code = await generate_unique_code()
     now = datetime.utcnow()
 
     share_doc = {
-        "code": code,
         "type": req.type,
         "content": req.content,
         "owner_user_id": current_user["id"],
         "created_at": now,
     }
 
-    await shares_collection.insert_one(share_doc)
+    code = await insert_share_with_unique_code(share_doc)
 
     return {
         "status": "ok",
@@ -895,7 +1479,9 @@ async def share_get(
     if len(code) != 6 or not code.isdigit():
         raise HTTPException(400, "Invalid code format")
 
-    doc = await shares_collection.find_one({"code": code})
+    doc = await shares_collection.find_one(
+        {"code": code}, {"_id": 0, "type": 1, "content": 1, "code": 1}
+    )
 
     if not doc:
         raise HTTPException(404, "Share code not found")